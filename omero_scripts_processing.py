@@ -18,20 +18,16 @@
 
 import os
 import os.path
-import subprocess
-import fcntl
 import time
 import tempfile
 import sys
-import distutils.spawn
-import time
-import threading
 import errno
 
+## OMERO.processor imports each script to read its parameter definitions
+## before the user ever launches it, so only omero.scripts is imported
+## here.  Everything else needed for the actual processing is imported
+## when used.
 import omero.scripts
-import omero.gateway
-import omero.cli
-import omero.rtypes
 
 class processing_error(Exception):
   """Base exception class for omero_scripts_processing."""
@@ -58,6 +54,27 @@ class bin_bad_exit(block_error):
   """Binary in bin block exited with non-zero."""
 
 
+_bin_cache = {}
+"""Cache of executables found on PATH, indexed by their name."""
+
+def find_bin(name):
+  """Find executable on PATH.
+
+  Lookups are cached so that each executable is only searched once
+  for each process.
+
+  Args:
+    name: string with the name of the executable.
+
+  Returns:
+    String with the path for the executable or None if not found.
+  """
+  if name not in _bin_cache:
+    import distutils.spawn
+    _bin_cache[name] = distutils.spawn.find_executable(name)
+  return _bin_cache[name]
+
+
 class block(object):
   """Base class for individual image processing blocks.
 
@@ -77,6 +94,33 @@ class block(object):
   institutions = []   # list of strings with institution names
   contact      = ""   # string with contact name
 
+  direct_read = False
+  """Whether to read the parent image files directly from the binary
+  repository, when it is readable from this node, rather than exporting
+  them from the server.  This avoids copying the image but the files
+  will be in their original format and not an ome.tiff.
+
+  Note that non-admin users, who normally run the processing scripts,
+  can't read the server configuration.  For this to work, deployments
+  must set `data_dir`, and `managed_dir` if different from the default,
+  on the block or on a site subclass.
+  """
+
+  data_dir = None
+  """Path for the OMERO binary repository.  If None, it is read from
+  the server `omero.data.dir` property when needed, which only works
+  for admin users, so deployments using `direct_read` must set it.
+  An empty string means the path is not known and direct reads are
+  not attempted.
+  """
+
+  managed_dir = None
+  """Path for the OMERO managed repository, where the files of images
+  imported as filesets are.  If None, it is read from the server
+  `omero.managed.dir` property, and defaults to `ManagedRepository`
+  inside `data_dir` if that is not set.
+  """
+
   def __init__(self):
     """Construct an omero scripts processing block.
 
@@ -93,6 +137,8 @@ class block(object):
     ##     when the same block appears repeated in the chain.
     self.args = []
     self._tmpfiles = []
+    self._localfiles = []
+    self.config_errors = []
 
   ## TODO investigate something nicer
   def get_tmp_file(self, suffix = ""):
@@ -119,7 +165,154 @@ class block(object):
           errors.append(e)
       except Exception as e:
         errors.append(e)
+    ## Files from the binary repository are only closed, never removed.
+    for f in self._localfiles:
+      try:
+        f.close()
+      except Exception as e:
+        errors.append(e)
+    self._tmpfiles = []
+    self._localfiles = []
+
+  def get_config_value(self, key):
+    """Get value of a server configuration property.
 
+    Failures, e.g., non-admin users can't read most properties, are
+    appended to the `config_errors` attribute and not raised, since
+    these values are only needed for optional features.
+
+    Returns:
+      String with the value, empty if it can't be read or is not set.
+    """
+    try:
+      return self.conn.getConfigService().getConfigValue(key) or ""
+    except Exception as e:
+      self.config_errors.append(e)
+      return ""
+
+  def get_data_dir(self):
+    """Get path for the OMERO binary repository.
+
+    The server is only queried once per block, even if it fails.
+
+    Returns:
+      String with the path, empty if it can't be found.
+    """
+    if self.data_dir is None:
+      self.data_dir = self.get_config_value("omero.data.dir")
+    return self.data_dir
+
+  def get_managed_dir(self):
+    """Get path for the OMERO managed repository.
+
+    The server is only queried once per block, even if it fails.
+
+    Returns:
+      String with the path, empty if it can't be found.
+    """
+    if self.managed_dir is None:
+      self.managed_dir = self.get_config_value("omero.managed.dir")
+      if not self.managed_dir and self.get_data_dir():
+        self.managed_dir = os.path.join(self.get_data_dir(),
+                                        "ManagedRepository")
+    return self.managed_dir
+
+  @staticmethod
+  def get_pixels_path(data_dir, pixels_id):
+    """Get path for a pixels file in the binary repository.
+
+    Pixels files are split into `Dir-NNN` subdirectories by the server
+    once the ID reaches 1000, e.g., pixels 1234567 are in
+    `Pixels/Dir-001/Dir-234/1234567`.  This is the same as the server
+    AbstractFileSystemService.getPath.
+    """
+    dirs = []
+    remaining = pixels_id
+    while remaining > 999:
+      remaining //= 1000
+      if remaining > 0:
+        dirs.insert(0, "Dir-%03d" % (remaining % 1000))
+    return os.path.join(data_dir, "Pixels", *(dirs + [str(pixels_id)]))
+
+  def get_local_files(self, fileset = False):
+    """Get paths for the parent image files in the binary repository.
+
+    Only useful when running in the same node as the binary repository.
+    For images imported as a fileset, these are the paths for all the
+    files in the fileset, in the managed repository.  For older images,
+    without a fileset, this is the path for its pixels file.
+
+    Args:
+      fileset: omero.gateway.FilesetWrapper of the parent image, or
+        None if it has no fileset, if already retrieved to avoid asking
+        the server again.
+
+    Returns:
+      List of strings with the file paths, or None if any of them is
+      not readable from this node.
+    """
+    if fileset is False:
+      fileset = self.parent.getFileset()
+    if fileset:
+      managed_dir = self.get_managed_dir()
+      if not managed_dir:
+        return None
+      paths = [os.path.join(managed_dir, f.getPath(), f.getName())
+               for f in fileset.listFiles()]
+    else:
+      data_dir = self.get_data_dir()
+      if not data_dir:
+        return None
+      pixels = self.parent.getPrimaryPixels()
+      paths = [self.get_pixels_path(data_dir, pixels.getId())]
+
+    if not paths or not all(os.path.isfile(p) and os.access(p, os.R_OK)
+                            for p in paths):
+      return None
+    return paths
+
+  def map_local_files(self):
+    """Memory map the parent image files in the binary repository.
+
+    The files are mapped read-only so there is no copy at all.  The
+    maps are closed at the end of processing.  Like `get_parent_file`,
+    this is only done if `direct_read` is set.
+
+    Like `get_parent_file`, images that are not the only image of
+    their fileset are not mapped since it would not be possible to
+    tell which bytes belong to the parent image.
+
+    Returns:
+      List of `mmap.mmap` objects, in the same order as the paths from
+      `get_local_files`, or None if `direct_read` is not set or the
+      files can't be mapped, in which case the image should be
+      exported instead.  These are the whole files of the fileset, in
+      their original format, or the raw planes of the pixels file for
+      images without a fileset.
+    """
+    import mmap
+
+    if not self.direct_read:
+      return None
+    fileset = self.parent.getFileset()
+    if fileset and len(list(fileset.copyImages())) != 1:
+      return None
+    paths = self.get_local_files(fileset)
+    if paths is None:
+      return None
+    maps = []
+    try:
+      for path in paths:
+        with open(path, "rb") as f:
+          maps.append(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+    ## Empty files can't be mapped (ValueError), and files may have
+    ## changed since get_local_files checked them.
+    except (IOError, OSError, ValueError):
+      for m in maps:
+        m.close()
+      return None
+    self._localfiles.extend(maps)
+    return maps
 
   def launch(self, parent):
     """Performs the whole processing block."""
@@ -215,32 +408,103 @@ class bin_block(block):
   image.
   """
 
+  bin_name = None
+  """Name of the executable to find in the system.  If None, defaults
+  to the class name.
+  """
+
   def __init__(self, bin_path = None):
     """Constructor.
 
+    The binary is not searched for nor checked here but only when
+    the block is launched.  This keeps the definition of the script
+    parameters fast.
+
     Args:
       bin_path: string defining the path for the binary to use.  If None,
-        default to the class name to find an executable in the system.
-
-    Responsabilities:
-      * set the `bin` attribute with the path for an executable.
+        default to `bin_name` to find an executable in the system.
     """
     super(bin_block, self).__init__()
+    self.bin_path = bin_path
+    self._bin = None
 
-    self.bin = (bin_path
-                or distutils.spawn.find_executable(self.__class__.__name__))
-    if not self.bin:
-      raise no_bin("No executable path defined")
-    elif not os.path.exists(self.bin):
-      raise no_bin("Executable `%s` does not exist" % self.bin)
-    elif not os.path.isfile(self.bin):
-      raise no_bin("Path `%s` is not an executable" % self.bin)
+  def check_bin(self):
+    """Find and check the executable.
+
+    The path is only searched for and checked once, later calls
+    return the same path.
+
+    Returns:
+      String with the path for the executable.
+
+    Raises:
+      no_bin: executable is not defined or does not exist.
+    """
+    if self._bin is None:
+      path = (self.bin_path
+              or find_bin(self.bin_name or self.__class__.__name__))
+      if not path:
+        raise no_bin("No executable path defined")
+      elif not os.path.exists(path):
+        raise no_bin("Executable `%s` does not exist" % path)
+      elif not os.path.isfile(path):
+        raise no_bin("Path `%s` is not an executable" % path)
+      self._bin = path
+    return self._bin
+
+  @property
+  def bin(self):
+    """Path for the executable.  See `check_bin`."""
+    return self.check_bin()
+
+  @bin.setter
+  def bin(self, path):
+    self._bin = path
 
   def get_parent(self, parent):
     ## TODO We can have this method use self.parent.exportOmeTiff() by
     ##      default when the subclass does not get a file.
     super(bin_block, self).get_parent(parent)
 
+  def get_parent_file(self, suffix = ".tiff"):
+    """Get parent image into an image file.
+
+    If `direct_read` is set, and the parent image is the only image of
+    a single file fileset readable from this node, returns that file
+    opened read-only.  Otherwise, exports the parent into an ome.tiff
+    temporary file.
+
+    Note that the file from the fileset is in its original format,
+    e.g., .dv or .czi, and not an ome.tiff.
+
+    Args:
+      suffix: string with the suffix for the exported temporary file.
+        Not used when the file is read directly.
+
+    Returns:
+      `file` object of the image file.
+    """
+    if self.direct_read:
+      ## Pixels files are raw planes, not something a binary can read,
+      ## and the binary would not know which image of a multi image
+      ## file it should process.
+      fileset = self.parent.getFileset()
+      if fileset and len(list(fileset.copyImages())) == 1:
+        paths = self.get_local_files(fileset)
+        if paths and len(paths) == 1:
+          try:
+            f = open(paths[0], "rb")
+          except (IOError, OSError):
+            pass
+          else:
+            self._localfiles.append(f)
+            return f
+
+    f = self.get_tmp_file(suffix = suffix)
+    f.write(self.parent.exportOmeTiff())
+    f.flush()
+    return f
+
   def parse_options(self):
     """Create list of arguments that is used.
 
@@ -275,6 +539,8 @@ class bin_block(block):
     else:
       timeout = lambda : False
 
+    import subprocess
+
     self.flog.write("$ %s\n" % " ".join(args))
     self.flog.flush()
 
@@ -292,6 +558,7 @@ class bin_block(block):
 
   def send_child(self):
     """Send/export/upload processed image back into omero."""
+    import omero.cli
 
     cli = omero.cli.CLI()
     cli.loadplugins()
@@ -415,14 +682,27 @@ class matlab_block(pipe_block):
   Because Matlab is really not meant to do this sort of things.
   """
 
-  interpreter = distutils.spawn.find_executable("matlab")
-  """The path for Matlab's intepreter."""
+  bin_name = "matlab"
+
+  @property
+  def interpreter(self):
+    """The path for Matlab's intepreter, same as `bin`.
+
+    It is searched for in the system when first used.  Subclasses
+    can still override it with a class attribute for the path.
+    """
+    return self.bin
 
   interpreter_options = ["-nodisplay", "-nosplash", "-nojvm"]
   """List of options to use when starting Matlab."""
 
   def __init__(self):
-    super(matlab_block, self).__init__(bin_path = self.interpreter)
+    ## Only use `interpreter` if a subclass has overriden the property
+    ## with a path, otherwise we would be searching for Matlab already.
+    interpreter = type(self).interpreter
+    if isinstance(interpreter, property):
+      interpreter = None
+    super(matlab_block, self).__init__(bin_path = interpreter)
 
   @staticmethod
   def bool_py2m(b):
@@ -432,12 +712,14 @@ class matlab_block(pipe_block):
   def get_parent(self, parent):
     """Get parent image into an image file.
 
-    Creates an ome.tiff and sets self.fin to it.
+    Sets self.fin to the image file from `get_parent_file`.  This
+    is an ome.tiff unless `direct_read` is set, in which case it may
+    be the original file in any format, e.g., .dv or .czi.  Subclasses
+    whose Matlab code only reads ome.tiff files should not set
+    `direct_read`.
     """
     super(matlab_block, self).get_parent(parent)
-    self.fin = self.get_tmp_file(suffix = ".tiff")
-    self.fin.write(self.parent.exportOmeTiff())
-    self.fin.flush()
+    self.fin = self.get_parent_file(suffix = ".tiff")
 
   @staticmethod
   def protect_exit(code):
@@ -472,9 +754,11 @@ class matlab_block(pipe_block):
 
   def start_matlab(self):
     """Start the Matlab session."""
+    import subprocess
+    import fcntl
 
     self.session = subprocess.Popen(
-      [self.interpreter] + self.interpreter_options,
+      [self.bin] + self.interpreter_options,
       stdin  = subprocess.PIPE,
       stdout = subprocess.PIPE,
     )
@@ -619,8 +903,25 @@ class chain(object):
   def launch(self):
     """Start the chain of processing blocks.
     """
-
+    ## When OMERO.processor only wants the parameter definitions, the
+    ## script client exits here, so import the rest only after it.
     self.client = omero.scripts.client(self.title, self.doc, *self.args)
+
+    import threading
+    import omero.gateway
+    import omero.rtypes
+
+    ## Binaries are only searched for when the chain is launched.  Check
+    ## them all now, before processing any image, so that a missing
+    ## binary is reported to the user instead of failing every image.
+    for block in self.blocks:
+      if hasattr(block, "check_bin"):
+        try:
+          block.check_bin()
+        except no_bin as e:
+          self.client.setOutput("Message", omero.rtypes.rstring(str(e)))
+          return
+
     self.conn = omero.gateway.BlitzGateway(client_obj = self.client)
 
     ## Connection is always lost after around ~ 10min (configurable in